@@ -0,0 +1,13 @@
+# 离线编译随机森林模型为本地动态库，供程序APP.py加载以加速单样本推理
+# 依赖：pip install treelite tl2cgen，并需要gcc编译器
+# 用法：python compile_model.py
+# 注意：rf_model.joblib更新后必须重新运行本脚本，否则rf.so的预测结果会与SHAP解释不一致
+# （程序加载rf.so时会与原模型做一致性校验，不一致时回退到ONNX Runtime推理）
+import joblib
+import treelite
+import tl2cgen
+
+model = joblib.load('rf_model.joblib')
+tl_model = treelite.sklearn.import_model(model)
+tl2cgen.export_lib(tl_model, toolchain='gcc', libpath='rf.so', params={'parallel_comp': 4})
+print("已生成 rf.so")
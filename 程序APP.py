@@ -1,16 +1,19 @@
+import logging
+import os
+import string
 import streamlit as st
 import joblib
 import numpy as np
-import pandas as pd
 import shap
-import matplotlib.pyplot as plt
+import plotly.graph_objects as go
+
+logger = logging.getLogger(__name__)
 
 # 加载Font Awesome图标库
-st.markdown('<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">',
-            unsafe_allow_html=True)
+FA_LINK = '<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">'
 
 # 自定义页面样式
-st.markdown("""
+CSS = """
 <style>
     /* 修改结果卡片样式 */
     .result-card {
@@ -32,13 +35,53 @@ st.markdown("""
         background: #fff5f5 !important;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# 页面标题
+TITLE_HTML = """
+<div style="text-align: center; margin: 3rem 0 2rem; padding: 0 2rem;">
+    <h1 style="color: var(--primary-color); 
+              font-size: 2.0rem; 
+              margin: 0 auto 1rem;
+              max-width: 1200px;
+              line-height: 1.2;
+              padding: 1.5rem 0;
+              border-bottom: 3px solid #4CAF50;
+              display: inline-block;">
+        <i class="fas fa-heartbeat" style="margin-right: 1rem;"></i>
+        乳腺癌术后阈下抑郁风险评估系统
+    </h1>
+    <p style="color: #6c757d; 
+             font-size: 1.1rem;
+             max-width: 1200px;
+             margin: 1rem auto;
+             padding: 0 2rem;">
+        基于机器学习与可解释性AI的临床决策支持系统
+    </p>
+</div>
+"""
+
+# 页脚
+FOOTER_HTML = """
+<hr style="margin: 4rem 0 2rem 0; border-top: 1px solid #e9ecef;"/>
+<div style="text-align: center; color: #6c757d; font-size: 0.9rem;">
+    <p>淮北市人民医院肿瘤内科护理组</p>
+    <p style="margin-top: 0.5rem;">
+        <i class="fas fa-exclamation-triangle"></i> 
+        *本系统预测结果仅供学术研究参考，不作为最终临床诊断依据*
+    </p>
+</div>
+"""
+
+# 图标库、样式与标题合并为一次输出
+STATIC_HTML = FA_LINK + CSS + TITLE_HTML
+st.markdown(STATIC_HTML, unsafe_allow_html=True)
 
 
 # 加载模型
 @st.cache_resource
 def load_model():
-    model = joblib.load('rf_model.pkl')
+    model = joblib.load('rf_model.joblib')
     # 验证模型类别
     if model.classes_.tolist() != [0, 1]:
         st.error("模型类别定义异常，请确认训练标签顺序应为[0, 1]！")
@@ -46,6 +89,74 @@ def load_model():
     return model
 
 
+@st.cache_resource
+def get_explainer(_model):
+    # 参数以下划线开头，避免Streamlit对sklearn模型做哈希
+    return shap.TreeExplainer(_model, feature_names=FEATURE_COLS, feature_perturbation='tree_path_dependent')
+
+
+# 转换为ONNX模型，单样本推理走ONNX Runtime（sklearn模型仅保留给SHAP使用）
+@st.cache_resource
+def load_session():
+    import onnxruntime as rt
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+
+    model = load_model()
+    onnx_model = convert_sklearn(
+        model,
+        initial_types=[('X', FloatTensorType([None, model.n_features_in_]))],
+        options={id(model): {'zipmap': False}}
+    )
+    return rt.InferenceSession(onnx_model.SerializeToString(), providers=['CPUExecutionProvider'])
+
+
+# 校验加速推理与sklearn模型结果一致，探针样本取在各分裂阈值处（最易出现偏差）
+def check_parity(predict):
+    model = load_model()
+    base_row = [spec.get("default", spec.get("options", [0])[0]) for spec in feature_ranges.values()]
+    probes = []
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        split = tree.feature >= 0
+        rows = np.tile(base_row, (split.sum(), 1))
+        rows[np.arange(split.sum()), tree.feature[split]] = tree.threshold[split]
+        probes.append(rows)
+    probes = np.vstack(probes).astype(np.float32)
+    return np.allclose(predict(probes), model.predict_proba(probes), atol=1e-6)
+
+
+def treelite_predictor():
+    import tl2cgen
+    predictor = tl2cgen.Predictor('rf.so')
+    # Treelite导入的随机森林阈值为float64，输入需保持一致；输出形状为(样本, 1, 类别)
+    return lambda features: predictor.predict(tl2cgen.DMatrix(features, dtype='float64'))[:, 0]
+
+
+def onnx_predictor():
+    session = load_session()
+    return lambda features: session.run(None, {'X': features})[1]
+
+
+# 依次尝试Treelite模型库rf.so（由compile_model.py生成）、ONNX Runtime，
+# 加载失败或与原模型结果不一致时回退到下一种，最终回退到sklearn模型本身
+# 返回的函数输入float32特征矩阵，输出各样本的类别概率
+@st.cache_resource
+def load_predictor():
+    candidates = [("ONNX模型", onnx_predictor)]
+    if os.path.exists('rf.so'):
+        candidates.insert(0, ("Treelite模型库rf.so", treelite_predictor))
+    for name, build in candidates:
+        try:
+            predict = build()
+        except Exception:
+            logger.warning("%s加载失败，回退到下一种推理方式", name, exc_info=True)
+            continue
+        if check_parity(predict):
+            return predict
+        logger.warning("%s推理结果与原模型不一致，回退到下一种推理方式", name)
+    return load_model().predict_proba
+
 model = load_model()
 
 # 特征定义
@@ -99,32 +210,91 @@ feature_ranges = {
     },
 }
 
-# 页面标题
-st.markdown("""
-<div style="text-align: center; margin: 3rem 0 2rem; padding: 0 2rem;">
-    <h1 style="color: var(--primary-color); 
-              font-size: 2.0rem; 
-              margin: 0 auto 1rem;
-              max-width: 1200px;
-              line-height: 1.2;
-              padding: 1.5rem 0;
-              border-bottom: 3px solid #4CAF50;
-              display: inline-block;">
-        <i class="fas fa-heartbeat" style="margin-right: 1rem;"></i>
-        乳腺癌术后阈下抑郁风险评估系统
-    </h1>
-    <p style="color: #6c757d; 
-             font-size: 1.1rem;
-             max-width: 1200px;
-             margin: 1rem auto;
-             padding: 0 2rem;">
-        基于机器学习与可解释性AI的临床决策支持系统
-    </p>
-</div>
-""", unsafe_allow_html=True)
+FEATURE_COLS = list(feature_ranges)
+N_FEATURES = len(FEATURE_COLS)
+# 图表使用英文特征名称
+FEATURE_LABELS = tuple(v['en_name'] for v in feature_ranges.values())
 
-# 输入表单
-with st.container():
+# 结果卡片模板及高/低风险两种样式
+RESULT_TPL = string.Template("""
+        <div class="result-card $cls">
+            <div style="position: relative; z-index: 3;">
+                <div style="font-size: 1.4rem; margin-bottom: 1.5rem; color: $color;">
+                    <i class="fas fa-$icon"></i>
+                    风险评估结论
+                </div>
+                <div class="metric-value">
+                    $label
+                </div>
+                <div class="risk-details">
+                    <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 2rem;">
+                        <div>
+                            <div style="font-size: 1.1rem; color: #666; margin-bottom: 0.5rem;">
+                                <i class="fas fa-arrow-up"></i>
+                                阳性概率
+                            </div>
+                            <div style="font-size: 1.8rem; color: $color; font-weight: 700;">
+                                $pos%
+                            </div>
+                        </div>
+                        <div>
+                            <div style="font-size: 1.1rem; color: #666; margin-bottom: 0.5rem;">
+                                <i class="fas fa-arrow-down"></i>
+                                阴性概率
+                            </div>
+                            <div style="font-size: 1.8rem; color: #6c757d; font-weight: 700;">
+                                $neg%
+                            </div>
+                        </div>
+                    </div>
+                </div>
+                <div class="risk-threshold" style="margin-top: 1.5rem;">
+                    <i class="fas fa-info-circle"></i>
+                    临床建议：$advice
+                </div>
+            </div>
+        </div>
+""")
+THEME = {
+    1: dict(cls='high-risk', color='#ff4b4b', icon='exclamation-triangle', label='高风险', advice='建议立即启动心理干预流程'),
+    0: dict(cls='', color='#4CAF50', icon='check-circle', label='低风险', advice='建议定期随访观察'),
+}
+
+
+# 计算预测概率与SHAP值（单样本仅需微秒级，直接计算比跨会话缓存的哈希与反序列化更快）
+def evaluate(values_tuple):
+    model = load_model()
+    # 直接构建float32输入，ONNX与SHAP直接使用（Treelite路径在load_predictor中转为float64）
+    features = np.fromiter(values_tuple, dtype=np.float32, count=N_FEATURES).reshape(1, N_FEATURES)
+    # 单样本推理与SHAP计算均为微秒级，直接在当前会话线程中串行执行，线程切换开销反而更大
+    proba = load_predictor()(features)[0]
+    # 直接调用shap_values走C扩展，跳过Explanation对象构建与可加性校验
+    shap_values = get_explainer(model).shap_values(features, check_additivity=False)
+    if isinstance(shap_values, list):  # 旧版shap按类别返回列表
+        shap_values = np.stack(shap_values, axis=-1)
+    return proba, shap_values
+
+
+# 绘制SHAP特征影响图（浏览器端渲染，服务端仅构建少量JSON，每次直接重建比缓存反序列化更快）
+def make_shap_fig(current_shap_values):
+    fig = go.Figure(go.Bar(
+        x=current_shap_values,
+        y=FEATURE_LABELS,
+        orientation='h',
+        marker_color=np.where(current_shap_values > 0, '#ff6b6b', '#4CAF50'),
+        text=np.char.mod('%.2f', current_shap_values)
+    ))
+    fig.update_layout(
+        height=400,
+        margin=dict(l=120, r=20, t=40, b=40),
+        title='特征影响分析',
+        xaxis_title='SHAP Value'
+    )
+    return fig
+
+
+# 输入表单（提交时统一触发一次重新运行）
+with st.form("risk_form"):
     st.markdown('<div class="feature-card">', unsafe_allow_html=True)
     st.markdown("### 🧬 患者特征输入")
 
@@ -200,60 +370,31 @@ with st.container():
 
     st.markdown('</div>', unsafe_allow_html=True)
 
-# 预测按钮
-if st.button("🚀 开始风险评估", use_container_width=True):
-    features = np.array([feature_values])
+    # 预测按钮
+    submitted = st.form_submit_button("🚀 开始风险评估", use_container_width=True)
 
+if submitted:
     try:
-        proba_array = model.predict_proba(features)[0]
+        values_tuple = tuple(feature_values)
+        # 输入未变化时直接复用本会话上次的结果，跳过预测与SHAP计算
+        if 'last' in st.session_state and st.session_state.last[0] == values_tuple:
+            proba_array, shap_values = st.session_state.last[1:]
+        else:
+            proba_array, shap_values = evaluate(values_tuple)
+            st.session_state.last = (values_tuple, proba_array, shap_values)
         if len(proba_array) != 2:
             raise ValueError("模型输出维度异常")
 
         probability_positive = proba_array[1] * 100
         probability_negative = proba_array[0] * 100
         predicted_class = 1 if probability_positive >= 50 else 0
-        predicted_label = "高风险" if predicted_class == 1 else "低风险"
 
         # 结果展示
-        st.markdown(f"""
-        <div class="result-card {'high-risk' if predicted_class == 1 else ''}">
-            <div style="position: relative; z-index: 3;">
-                <div style="font-size: 1.4rem; margin-bottom: 1.5rem; color: {'#ff4b4b' if predicted_class == 1 else '#4CAF50'};">
-                    <i class="fas fa-{'exclamation-triangle' if predicted_class == 1 else 'check-circle'}"></i>
-                    风险评估结论
-                </div>
-                <div class="metric-value">
-                    {predicted_label}
-                </div>
-                <div class="risk-details">
-                    <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 2rem;">
-                        <div>
-                            <div style="font-size: 1.1rem; color: #666; margin-bottom: 0.5rem;">
-                                <i class="fas fa-arrow-up"></i>
-                                阳性概率
-                            </div>
-                            <div style="font-size: 1.8rem; color: {'#ff4b4b' if predicted_class == 1 else '#4CAF50'}; font-weight: 700;">
-                                {probability_positive:.1f}%
-                            </div>
-                        </div>
-                        <div>
-                            <div style="font-size: 1.1rem; color: #666; margin-bottom: 0.5rem;">
-                                <i class="fas fa-arrow-down"></i>
-                                阴性概率
-                            </div>
-                            <div style="font-size: 1.8rem; color: #6c757d; font-weight: 700;">
-                                {probability_negative:.1f}%
-                            </div>
-                        </div>
-                    </div>
-                </div>
-                <div class="risk-threshold" style="margin-top: 1.5rem;">
-                    <i class="fas fa-info-circle"></i>
-                    临床建议：{'建议立即启动心理干预流程' if predicted_class == 1 else '建议定期随访观察'}
-                </div>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(RESULT_TPL.substitute(
+            **THEME[predicted_class],
+            pos=f'{probability_positive:.1f}',
+            neg=f'{probability_negative:.1f}'
+        ), unsafe_allow_html=True)
 
     except Exception as e:
         st.error(f"预测过程出现异常：{str(e)}")
@@ -261,61 +402,12 @@ if st.button("🚀 开始风险评估", use_container_width=True):
 
     # SHAP可视化部分
     with st.spinner("生成可解释性分析..."):
-        plt.rcParams['font.sans-serif'] = ['Arial']  # 使用系统默认英文字体
-        plt.rcParams['axes.unicode_minus'] = False
+        # 获取SHAP值并反转方向
+        arr = shap_values[0, :, predicted_class] if shap_values.ndim == 3 else shap_values[0]
+        current_shap_values = np.negative(arr)
 
-        sample_data = pd.DataFrame([feature_values], columns=feature_ranges.keys())
-        explainer = shap.TreeExplainer(model)
-        shap_values = explainer(sample_data)
-
-        # 获取SHAP值
-        if len(shap_values.shape) == 3:
-            current_shap_values = shap_values[0, :, predicted_class].values
-        else:
-            current_shap_values = shap_values[0, :, 1].values
-
-        current_shap_values = -current_shap_values  # 反转方向
-
-        # 创建专业级可视化
-        fig, ax = plt.subplots(figsize=(10, 6))
-        y_pos = np.arange(len(feature_ranges))
-
-        # 使用英文特征名称
-        feature_labels = [feature_ranges[f]['en_name'] for f in feature_ranges]  # 关键修改处
-
-        # 使用渐变色条
-        colors = ['#ff6b6b' if val > 0 else '#4CAF50' for val in current_shap_values]
-        bars = ax.barh(y_pos, current_shap_values, align='center', height=0.6, color=colors)
-
-        # 添加数据标签
-        for i, (val, name) in enumerate(zip(current_shap_values, feature_labels)):
-            ax.text(val / 2 if val > 0 else val * 1.2, i,
-                    f"{name}\n{val:.2f}",
-                    va='center',
-                    ha='left' if val < 0 else 'right',
-                    color='white' if abs(val) > 0.2 else '#666',
-                    fontsize=10)
-
-        # 美化坐标轴
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
-        ax.spines['left'].set_color('#cccccc')
-        ax.spines['bottom'].set_color('#cccccc')
-        ax.tick_params(axis='y', length=0)
-        ax.set_xlabel('SHAP Value', fontsize=12, color='#666')  # 改为英文标签
-        ax.set_title('Feature Impact Analysis',
-                     fontsize=14, pad=20,
-                     color='#2c3e50',
-                     fontweight='bold')
-
-        # 添加网格线
-        ax.grid(axis='x', linestyle='--', alpha=0.4, color='#cccccc')
-
-        # 调整布局
-        plt.tight_layout(pad=2)
-
-        st.pyplot(fig)
-        plt.close()
+        fig = make_shap_fig(current_shap_values)
+        st.plotly_chart(fig, use_container_width=True)
 
         st.caption(f"""
         影响因素说明：
@@ -342,13 +434,4 @@ with st.expander("📚 临床指标参考指南", expanded=False):
     """)
 
 # 页脚
-st.markdown("""
-<hr style="margin: 4rem 0 2rem 0; border-top: 1px solid #e9ecef;"/>
-<div style="text-align: center; color: #6c757d; font-size: 0.9rem;">
-    <p>淮北市人民医院肿瘤内科护理组</p>
-    <p style="margin-top: 0.5rem;">
-        <i class="fas fa-exclamation-triangle"></i> 
-        *本系统预测结果仅供学术研究参考，不作为最终临床诊断依据*
-    </p>
-</div>
-""", unsafe_allow_html=True)
+st.markdown(FOOTER_HTML, unsafe_allow_html=True)